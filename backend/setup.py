@@ -0,0 +1,16 @@
+'''
+optional: compiles the auth hot path with Cython
+    python setup.py build_ext --inplace
+places a compiled auth module next to src/auth/auth.py which python then
+imports in place of the source file; delete the built file to go back
+'''
+from setuptools import setup
+from Cython.Build import cythonize
+
+setup(
+    name='coffee-shop-backend',
+    ext_modules=cythonize(
+        ['src/auth/auth.py'],
+        compiler_directives={'language_level': 3}
+    )
+)
@@ -1,16 +1,61 @@
+import gzip
 import os
-from flask import Flask, request, jsonify, abort
-from sqlalchemy import exc
-import json
+from flask import Flask, Response, request, abort
+from sqlalchemy import exc, select
+from sqlalchemy.orm import raiseload
+import brotli
+import orjson
+import threading
+import time
 from flask_cors import CORS
+from flask_compress import Compress
 
-from .database.models import db_drop_and_create_all, setup_db, Drink
+from .database.models import db_drop_and_create_all, setup_db, db, Drink
 from .auth.auth import AuthError, requires_auth
 
 app = Flask(__name__)
 setup_db(app)
 CORS(app)
 
+# compress json bodies large enough to benefit, brotli when accepted
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+app.config['COMPRESS_MIN_SIZE'] = 1024
+Compress(app)
+
+'''
+JSONResponse
+    flask response carrying a json body
+    Flask 1.0 has no pluggable JSONProvider, so responses are serialized
+    with orjson through jsonify() below instead of flask.jsonify
+'''
+
+
+class JSONResponse(Response):
+    default_mimetype = 'application/json'
+
+
+def jsonify(payload):
+    return JSONResponse(orjson.dumps(payload))
+
+
+'''
+get_json_body(request)
+    parses the request body with orjson, skipping flask's get_json
+    aborts with 400 if the body is not a json object
+'''
+
+
+def get_json_body(request):
+    try:
+        data = orjson.loads(request.get_data(cache=False))
+    except orjson.JSONDecodeError:
+        abort(400)
+
+    if not isinstance(data, dict):
+        abort(400)
+    return data
+
+
 '''
 @DONE uncomment the following line to initialize the datbase
 !! NOTE THIS WILL DROP ALL RECORDS AND START YOUR DB FROM SCRATCH
@@ -18,12 +63,104 @@ CORS(app)
 '''
 # db_drop_and_create_all()
 
+DRINKS_PER_PAGE = 100
+
+'''
+drinks_page(request)
+    reads ?page= and ?per_page= (at most DRINKS_PER_PAGE) from the request
+    and returns them as a (page, per_page) tuple
+'''
+
+
+def drinks_page(request):
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = request.args.get('per_page', DRINKS_PER_PAGE, type=int)
+    per_page = min(max(per_page, 1), DRINKS_PER_PAGE)
+    return page, per_page
+
+
+'''
+paginate_drinks(page, per_page)
+    returns plain (id, title, recipe) rows for the given page through a core
+    select, so only the columns short() / long() need are loaded and no
+    Drink objects or orm row tuples are built
+'''
+
+
+def paginate_drinks(page, per_page):
+    query = select([Drink.id, Drink.title, Drink.recipe]) \
+        .order_by(Drink.id) \
+        .limit(per_page) \
+        .offset((page - 1) * per_page)
+    return db.session.execute(query).fetchall()
+
+
+'''
+public drinks cache
+    GET /drinks bodies are cached per page as serialized bytes and tagged
+    with _DRINKS_VER, together with br / gzip variants built once when the
+    body is large enough to compress. every successful write bumps the
+    version so stale pages are never served. the cache is per process, so
+    pages also expire after _DRINKS_CACHE_TTL seconds to bound how long
+    other workers serve a listing from before a write they did not handle.
+'''
+
+_DRINKS_CACHE = {"v": 0, "bodies": {}}
+_DRINKS_CACHE_SIZE = 256
+_DRINKS_CACHE_TTL = 5
+_DRINKS_VER = 0
+_DRINKS_LOCK = threading.Lock()
+
+
+def get_cached_drinks(page):
+    with _DRINKS_LOCK:
+        if _DRINKS_CACHE["v"] != _DRINKS_VER:
+            return None, _DRINKS_VER
+
+        cached = _DRINKS_CACHE["bodies"].get(page)
+        if (cached is None or
+                time.monotonic() - cached[0] >= _DRINKS_CACHE_TTL):
+            return None, _DRINKS_VER
+        return cached[1], _DRINKS_VER
+
+
+def compress_drinks(body):
+    variants = {'identity': body}
+    if len(body) >= app.config['COMPRESS_MIN_SIZE']:
+        # same levels flask-compress uses, brotli's default of 11 is far
+        # too slow to run on a cache miss
+        variants['br'] = brotli.compress(
+            body, quality=app.config['COMPRESS_BR_LEVEL'])
+        variants['gzip'] = gzip.compress(
+            body, compresslevel=app.config['COMPRESS_LEVEL'])
+    return variants
+
+
+def cache_drinks(page, variants, version):
+    with _DRINKS_LOCK:
+        # a write landed while this body was built, it may already be stale
+        if version != _DRINKS_VER:
+            return
+        bodies = _DRINKS_CACHE["bodies"]
+        if _DRINKS_CACHE["v"] != version or len(bodies) >= _DRINKS_CACHE_SIZE:
+            bodies = _DRINKS_CACHE["bodies"] = {}
+            _DRINKS_CACHE["v"] = version
+        bodies[page] = (time.monotonic(), variants)
+
+
+def invalidate_drinks_cache():
+    global _DRINKS_VER
+    with _DRINKS_LOCK:
+        _DRINKS_VER += 1
+
+
 # ROUTES
 '''
 @DONE implement endpoint
     GET /drinks
         it should be a public endpoint
         it should contain only the drink.short() data representation
+        it should accept optional ?page= and ?per_page= parameters
     returns status code 200 and json {"success": True, "drinks": drinks} where
     drinks is the list of drink or appropriate status code indicating reason
     for failure
@@ -32,12 +169,30 @@ CORS(app)
 
 @app.route('/drinks', methods=['GET'])
 def get_drinks():
-    all_drinks = Drink.query.all()
-    drinks = [drink.short() for drink in all_drinks]
+    page = drinks_page(request)
+    variants, version = get_cached_drinks(page)
+
+    if variants is None:
+        drinks = [{
+            'id': id,
+            'title': title,
+            'recipe': [{'color': r['color'], 'parts': r['parts']}
+                       for r in recipe]
+        } for id, title, recipe in paginate_drinks(*page)]
+
+        variants = compress_drinks(orjson.dumps({
+            "success": True,
+            "drinks": drinks}))
+        cache_drinks(page, variants, version)
 
-    return jsonify({
-        "success": True,
-        "drinks": drinks}), 200
+    # serve the stored variant, flask-compress leaves encoded bodies alone
+    encoding = request.accept_encodings.best_match(
+        [e for e in ('br', 'gzip') if e in variants], 'identity')
+    response = JSONResponse(variants[encoding])
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response, 200
 
 
 '''
@@ -45,6 +200,7 @@ def get_drinks():
     GET /drinks-detail
         it should require the 'get:drinks-detail' permission
         it should contain the drink.long() data representation
+        it should accept optional ?page= and ?per_page= parameters
     returns status code 200 and json {"success": True, "drinks": drinks} where
     drinks is the list of drinks or appropriate status code indicating reason
     for failure
@@ -54,8 +210,11 @@ def get_drinks():
 @app.route('/drinks-detail', methods=['GET'])
 @requires_auth('get:drinks-detail')
 def drinks_detail():
-    all_drinks = Drink.query.all()
-    drinks = [drink.long() for drink in all_drinks]
+    drinks = [{
+        'id': id,
+        'title': title,
+        'recipe': recipe
+    } for id, title, recipe in paginate_drinks(*drinks_page(request))]
 
     return jsonify({
         "success": True,
@@ -77,18 +236,17 @@ def drinks_detail():
 @app.route('/drinks', methods=['POST'])
 @requires_auth('post:drinks')
 def new_drink():
-    data = request.get_json()
-    if 'title' not in data.keys() or 'recipe' not in data.keys():
+    data = get_json_body(request)
+    if 'title' not in data or 'recipe' not in data:
         abort(400)
     title = data.get('title')
-
-    # make a string of json to store in database
-    recipe = json.dumps(data.get('recipe'))
+    recipe = data.get('recipe')
 
     drink = Drink(title=title, recipe=recipe)
 
     try:
         drink.insert()
+        invalidate_drinks_cache()
         return jsonify({
             "success": True,
             "drinks": [drink.long()]}), 200
@@ -114,20 +272,25 @@ def new_drink():
 def edit_drink(id):
 
     # use provided id to get specific drink from database
-    my_drink = Drink.query.get(id)
+    my_drink = Drink.query.options(raiseload('*')).get(id)
     if not my_drink:
         abort(404)
-    data = request.get_json()
-    if 'title' in data.keys():
+    data = get_json_body(request)
+    if 'title' in data:
         my_drink.title = data['title']
 
-    if 'recipe' in data.keys():
-        my_drink.recipe = json.dumps(data['recipe'])
+    if 'recipe' in data:
+        my_drink.recipe = data['recipe']
+
+    # serialize before the commit expires the instance, otherwise long()
+    # would select the row again
+    drink = my_drink.long()
     try:
         my_drink.update()
+        invalidate_drinks_cache()
         return jsonify({
             "success": True,
-            "drinks": my_drink.long()}), 200
+            "drinks": drink}), 200
 
     except:
         abort(422)
@@ -147,20 +310,44 @@ def edit_drink(id):
 @app.route('/drinks/<int:id>', methods=['DELETE'])
 @requires_auth('delete:drinks')
 def drop_drink(id):
-    my_drink = Drink.query.get(id)
-    if not my_drink:
-        abort(404)
 
+    # a single DELETE ... WHERE id, the row is never loaded
     try:
-        my_drink.delete()
-        return jsonify({
-            "success": True,
-            "delete": id}), 200
-
+        deleted = Drink.query.filter(Drink.id == id) \
+            .delete(synchronize_session=False)
+        db.session.commit()
     except:
         abort(422)
 
+    if not deleted:
+        abort(404)
+
+    invalidate_drinks_cache()
+    return jsonify({
+        "success": True,
+        "delete": id}), 200
+
 # Error Handling
+'''
+the fixed error bodies are serialized once at import time
+'''
+
+_ERR_400 = orjson.dumps({
+    "success": False,
+    "error": 400,
+    "message": "bad request"
+})
+_ERR_404 = orjson.dumps({
+    "success": False,
+    "error": 404,
+    "message": "resource not found"
+})
+_ERR_422 = orjson.dumps({
+    "success": False,
+    "error": 422,
+    "message": "unprocessable"
+})
+
 '''
 Example error handling for unprocessable entity
 '''
@@ -168,11 +355,7 @@ Example error handling for unprocessable entity
 
 @app.errorhandler(422)
 def unprocessable(error):
-    return jsonify({
-        "success": False,
-        "error": 422,
-        "message": "unprocessable"
-    }), 422
+    return JSONResponse(_ERR_422, status=422)
 
 
 '''
@@ -193,21 +376,13 @@ def unprocessable(error):
 
 
 @app.errorhandler(404)
-def unprocessable(error):
-    return jsonify({
-        "success": False,
-        "error": 404,
-        "message": "resource not found"
-    }), 404
+def not_found(error):
+    return JSONResponse(_ERR_404, status=404)
 
 
 @app.errorhandler(400)
-def unprocessable(error):
-    return jsonify({
-        "success": False,
-        "error": 400,
-        "message": "bad request"
-    }), 400
+def bad_request(error):
+    return JSONResponse(_ERR_400, status=400)
 
 '''
 @DONE implement error handler for AuthError
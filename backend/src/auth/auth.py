@@ -1,13 +1,60 @@
-import json
+import base64
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+import httpx
+import redis
 from flask import request, _request_ctx_stack
 from functools import wraps
-from jose import jwt
-from urllib.request import urlopen
+import jwt
+from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicNumbers
 
 # set domain and audience
 AUTH0_DOMAIN = 'dev-vibe.us.auth0.com'
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'coffee'
+_JWKS_URL = f"https://{AUTH0_DOMAIN}/.well-known/jwks.json"
+_ISSUER = f"https://{AUTH0_DOMAIN}/"
+_BEARER_RE = re.compile(r'[Bb][Ee][Aa][Rr][Ee][Rr] (\S+)')
+
+logger = logging.getLogger(__name__)
+
+# in-process cache of the Auth0 signing keys as parsed RSA public keys,
+# keyed by kid; the background refresher keeps them fresh, a request only
+# fetches them itself while no keys were ever loaded
+_JWKS_CACHE = {"last_good": 0, "last_attempt": 0}
+_KEY_CACHE = {}
+_JWKS_REFRESH_INTERVAL = 300
+_JWKS_MIN_REFRESH_INTERVAL = 10
+_JWKS_MAX_AGE = 3600
+_JWKS_REFRESH = threading.Event()
+_JWKS_FETCH_LOCK = threading.Lock()
+
+# the refresher is started at import and again in every forked child, so
+# workers forked from a preloaded app get their own thread and http client
+_REFRESHER = {"pid": None}
+_http = None
+
+# revoked tokens are published through redis; leave REDIS_URL unset to
+# run without revocation
+REDIS_URL = os.environ.get('REDIS_URL')
+REVOKED_TOKENS_KEY = 'revoked_access_tokens'
+REVOKED_EVENTS_STREAM = 'revoked_access_token_events'
+REVOKED_BLOOM_KEY = 'bloom:revoked'
+REVOKED_BLOOM_BITS = 1 << 20
+REVOKED_BLOOM_HASHES = 7
+_REVOKED_REFRESH_INTERVAL = 60
+
+# the listener runs once per process, forked children start their own
+_LISTENER = {"pid": None}
+_redis = None
+
+# jti -> expiry of every revoked token this worker knows about
+_REVOKED = {}
+_REVOKED_BLOOM = {"fetched_at": 0, "filter": None}
 
 # AuthError Exception
 '''
@@ -22,6 +69,138 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+# Token Revocation
+'''
+revoked tokens are kept in the sorted set REVOKED_TOKENS_KEY (scored by the
+token expiry) and announced on the stream REVOKED_EVENTS_STREAM with
+'jti' and 'exp' fields. every worker mirrors them from a background thread
+so checking a token rarely touches the network.
+
+REVOKED_BLOOM_KEY holds a bloom filter of the same jtis: a string of
+REVOKED_BLOOM_BITS bits in redis SETBIT / GETBIT order (bit 0 is the most
+significant bit of the first byte). missing trailing bytes count as zero,
+so a producer may grow the string with SETBIT. a jti sets the
+REVOKED_BLOOM_HASHES bits (h1 + i * h2) % REVOKED_BLOOM_BITS for i from 0,
+where h1 and h2 are the first and last 8 bytes, little endian, of the
+16 byte blake2b digest of the utf-8 jti.
+'''
+
+
+class _BloomFilter:
+    def __init__(self, bits, size, hashes):
+        self.bits = bits
+        self.size = size
+        self.hashes = hashes
+
+    def __contains__(self, item):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little')
+        for i in range(self.hashes):
+            bit = (h1 + i * h2) % self.size
+            byte = bit >> 3
+            if byte >= len(self.bits) or \
+                    not self.bits[byte] & (0x80 >> (bit & 7)):
+                return False
+        return True
+
+
+def _refresh_bloom():
+    bits = _redis.get(REVOKED_BLOOM_KEY)
+    _REVOKED_BLOOM["filter"] = (
+        _BloomFilter(bits, REVOKED_BLOOM_BITS, REVOKED_BLOOM_HASHES)
+        if bits else None)
+    _REVOKED_BLOOM["fetched_at"] = time.monotonic()
+
+
+def _prune_revoked():
+    now = time.time()
+    for jti, exp in list(_REVOKED.items()):
+        if exp < now:
+            _REVOKED.pop(jti, None)
+
+
+def _seed_revoked():
+    revoked = _redis.zrangebyscore(REVOKED_TOKENS_KEY, time.time(), '+inf',
+                                   withscores=True)
+    for jti, exp in revoked:
+        _REVOKED[jti.decode('utf-8')] = exp
+
+
+def _revocation_listener():
+    last_id = None
+    while True:
+        try:
+            if last_id is None:
+                # remember the stream position before seeding so no event
+                # published in between is lost
+                latest = _redis.xrevrange(REVOKED_EVENTS_STREAM, count=1)
+                start_id = latest[0][0] if latest else '0-0'
+                _seed_revoked()
+                last_id = start_id
+
+            streams = _redis.xread({REVOKED_EVENTS_STREAM: last_id},
+                                   block=_REVOKED_REFRESH_INTERVAL * 1000)
+            for _, events in streams:
+                for event_id, fields in events:
+                    last_id = event_id
+                    try:
+                        jti = fields[b'jti'].decode('utf-8')
+                        exp = float(fields.get(b'exp', b'+inf'))
+                    except (KeyError, ValueError):
+                        logger.warning("skipping malformed revocation "
+                                       "event %s", event_id)
+                        continue
+                    _REVOKED[jti] = exp
+
+            elapsed = time.monotonic() - _REVOKED_BLOOM["fetched_at"]
+            if elapsed >= _REVOKED_REFRESH_INTERVAL:
+                _refresh_bloom()
+                _prune_revoked()
+        except redis.RedisError:
+            time.sleep(1)
+        except Exception:
+            # keep the worker's revocation feed alive whatever goes wrong
+            logger.exception("revocation listener failed")
+            time.sleep(1)
+
+
+def _start_revocation_listener():
+    global _redis
+    if _LISTENER["pid"] == os.getpid():
+        return
+    _redis = redis.Redis.from_url(REDIS_URL)
+    threading.Thread(target=_revocation_listener, daemon=True).start()
+    _LISTENER["pid"] = os.getpid()
+
+
+'''
+_is_revoked(jti)
+    the local set catches everything the stream has delivered; the bloom
+    filter then decides whether redis must be asked, so a token that was
+    never revoked costs a dict lookup and a few bit tests
+'''
+
+
+def _is_revoked(jti):
+    if jti in _REVOKED:
+        return True
+
+    bloom = _REVOKED_BLOOM["filter"]
+    if bloom is None or jti not in bloom:
+        return False
+
+    try:
+        return _redis.zscore(REVOKED_TOKENS_KEY, jti) is not None
+    except redis.RedisError:
+        return False
+
+
+if REDIS_URL:
+    _start_revocation_listener()
+    os.register_at_fork(after_in_child=_start_revocation_listener)
+
+
 # Auth Header
 
 '''
@@ -35,27 +214,25 @@ class AuthError(Exception):
 
 
 def get_token_auth_header():
-    data = request.headers
+    header = request.headers.get('Authorization')
 
     # check if 'Authorization' is included in headers
-    if 'Authorization' not in data.keys():
+    if not header:
         raise AuthError(error={
             'code': 'authorization_header_missing',
             'description': 'Authorization header is expected'
         }, status_code=401)
 
-    auth_parts = data['Authorization'].split(' ')
-
     # check integrity of Authorization header
-    if len(auth_parts) != 2 or auth_parts[0].lower() != 'bearer':
+    match = _BEARER_RE.fullmatch(header)
+    if match is None:
         raise AuthError(error={
             'code': 'invalid_header',
             'description': "header must start with 'Bearer' and include proper"
                            " token"
         }, status_code=401)
 
-    token = auth_parts[1]
-    return token
+    return match.group(1)
 
 
 '''
@@ -73,15 +250,17 @@ def get_token_auth_header():
 
 def check_permissions(permission, payload):
 
-    # check if 'permissions' is included in payload
-    if 'permissions' not in payload.keys():
+    # check if 'permissions' is included in payload, verify_decode_jwt
+    # keeps them as a frozenset under '_perms'
+    perms = payload.get('_perms')
+    if perms is None:
         raise AuthError(error={
             'code': 'missing_permissions',
             'description': 'permissions must be sent with token'
         }, status_code=401)
 
     # check if needed permission is found in our token of certain user
-    if permission not in payload['permissions']:
+    if permission not in perms:
         raise AuthError(error={
             'code': 'not_authorized',
             'description': 'needed permission not found in permissions'
@@ -90,6 +269,141 @@ def check_permissions(permission, payload):
     return True
 
 
+def _b64_to_int(value):
+    padded = value + '=' * (-len(value) % 4)
+    return int.from_bytes(base64.urlsafe_b64decode(padded), 'big')
+
+
+def _load_public_key(jwk):
+    return RSAPublicNumbers(_b64_to_int(jwk["e"]),
+                            _b64_to_int(jwk["n"])).public_key()
+
+
+'''
+_is_signing_key(jwk)
+    true for the RSA signature keys verify_decode_jwt can use; encryption
+    keys and entries without kid, n or e are skipped
+'''
+
+
+def _is_signing_key(jwk):
+    return (isinstance(jwk, dict) and
+            jwk.get("kty") == "RSA" and
+            jwk.get("use", "sig") == "sig" and
+            all(isinstance(jwk.get(f), str) for f in ("kid", "n", "e")))
+
+
+def _refresh_jwks():
+    global _KEY_CACHE
+
+    # read data from auth0
+    response = _http.get(_JWKS_URL)
+    response.raise_for_status()
+    jwks = response.json()
+
+    # parse each jwk into a public key once instead of on every decode
+    keys = {}
+    for key in jwks["keys"]:
+        if not _is_signing_key(key):
+            continue
+        try:
+            keys[key["kid"]] = _load_public_key(key)
+        except (ValueError, TypeError):
+            logger.warning("skipping unusable JWK %s", key["kid"])
+
+    # keep serving the last good keys rather than swapping in none
+    if not keys:
+        raise ValueError("JWKS contains no usable signing keys")
+
+    _KEY_CACHE = keys
+    _JWKS_CACHE["last_good"] = time.monotonic()
+
+
+'''
+_jwks_refresher()
+    background loop keeping _KEY_CACHE warm; refreshes every
+    _JWKS_REFRESH_INTERVAL seconds or early when a request meets an unknown
+    kid, but never more often than _JWKS_MIN_REFRESH_INTERVAL. a failed
+    fetch is logged and keeps the last good keys
+'''
+
+
+def _attempt_refresh():
+    # callers hold _JWKS_FETCH_LOCK
+    _JWKS_CACHE["last_attempt"] = time.monotonic()
+    try:
+        _refresh_jwks()
+    except Exception:
+        logger.exception("failed to refresh the Auth0 JWKS")
+
+
+def _jwks_refresher():
+    while True:
+        _JWKS_REFRESH.clear()
+        with _JWKS_FETCH_LOCK:
+            _attempt_refresh()
+        time.sleep(_JWKS_MIN_REFRESH_INTERVAL)
+        _JWKS_REFRESH.wait(_JWKS_REFRESH_INTERVAL)
+
+
+def _start_jwks_refresher():
+    global _http, _JWKS_REFRESH, _JWKS_FETCH_LOCK
+    if _REFRESHER["pid"] == os.getpid():
+        return
+
+    # a forked child inherits these in whatever state the parent's
+    # threads left them, so it starts from fresh ones
+    _JWKS_REFRESH = threading.Event()
+    _JWKS_FETCH_LOCK = threading.Lock()
+    _http = httpx.Client(http2=True, timeout=10)
+    threading.Thread(target=_jwks_refresher, daemon=True).start()
+    _REFRESHER["pid"] = os.getpid()
+
+
+'''
+_load_initial_jwks()
+    called by requests while no keys were ever loaded; fetches the jwks
+    synchronously (bounded by the client timeout) unless the refresher is
+    already doing so or an attempt failed less than
+    _JWKS_MIN_REFRESH_INTERVAL seconds ago
+'''
+
+
+def _load_initial_jwks():
+    with _JWKS_FETCH_LOCK:
+        if _JWKS_CACHE["last_good"]:
+            return
+        elapsed = time.monotonic() - _JWKS_CACHE["last_attempt"]
+        if _JWKS_CACHE["last_attempt"] and \
+                elapsed < _JWKS_MIN_REFRESH_INTERVAL:
+            return
+        _attempt_refresh()
+
+
+'''
+_get_rsa_key(kid)
+    returns the cached public key for kid or None; only touches the network
+    while no keys were ever loaded. an unknown kid, or keys older than
+    _JWKS_MAX_AGE because refreshes keep failing, ask the refresher to
+    fetch the jwks early
+'''
+
+
+def _get_rsa_key(kid):
+    if not _JWKS_CACHE["last_good"]:
+        _load_initial_jwks()
+
+    key = _KEY_CACHE.get(kid)
+    if (key is None or
+            time.monotonic() - _JWKS_CACHE["last_good"] > _JWKS_MAX_AGE):
+        _JWKS_REFRESH.set()
+    return key
+
+
+_start_jwks_refresher()
+os.register_at_fork(after_in_child=_start_jwks_refresher)
+
+
 '''
 @DONE implement verify_decode_jwt(token) method
     @INPUTS
@@ -100,66 +414,70 @@ def check_permissions(permission, payload):
     it should decode the payload from the token
     it should validate the claims
     return the decoded payload
-
-    !!NOTE urlopen has a common certificate error described here:
-    https://stackoverflow.com/questions/50236117/scraping-ssl-certificate-verify-failed-error-for-http-en-wikipedia-org
 '''
 
 
 def verify_decode_jwt(token):
 
-    # read data from auth0
-    jsonurl = urlopen("https://" + AUTH0_DOMAIN + "/.well-known/jwks.json")
-    jwks = json.loads(jsonurl.read().decode('utf-8'))
-    unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
+    try:
+        unverified_header = jwt.get_unverified_header(token)
+    except jwt.InvalidTokenError:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Authorization malformed.'
+        }, 401)
 
     # check some integrity of provided token
-    if 'kid' not in unverified_header.keys():
+    if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
     # get rsa key to use it in decoding
-    for key in jwks["keys"]:
-        if key["kid"] == unverified_header["kid"]:
-            rsa_key = {
-                "kty": key["kty"],
-                "kid": key["kid"],
-                "use": key["use"],
-                "n": key["n"],
-                "e": key["e"]
-            }
+    public_key = _get_rsa_key(unverified_header["kid"])
 
-    # decode the token to return the payload
-    if rsa_key:
-        try:
-            payload = jwt.decode(
-                token,
-                rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer="https://" + AUTH0_DOMAIN + "/"
-            )
-            return payload
-
-        except jwt.ExpiredSignatureError:
-            raise AuthError({"code": "token_expired",
-                             "description": "token is expired"}, 401)
-        except jwt.JWTClaimsError:
-            raise AuthError({"code": "invalid_claims",
-                             "description":
-                                 "incorrect claims,"
-                                 "please check the audience and issuer"}, 401)
-        except Exception:
-            raise AuthError({"code": "invalid_header",
-                             "description":
-                                 "Unable to parse authentication"
-                                 " token."}, 401)
+    if public_key is None:
+        raise AuthError({"code": "key_rotation_in_progress",
+                         "description": "Unable to find appropriate key,"
+                                        " please retry shortly"}, 401)
 
-    raise AuthError({"code": "invalid_header",
-                     "description": "Unable to find appropriate key"}, 401)
+    # decode the token to return the payload
+    try:
+        payload = jwt.decode(
+            token,
+            public_key,
+            algorithms=ALGORITHMS,
+            audience=API_AUDIENCE,
+            issuer=_ISSUER
+        )
+
+    except jwt.ExpiredSignatureError:
+        raise AuthError({"code": "token_expired",
+                         "description": "token is expired"}, 401)
+    except (jwt.InvalidAudienceError, jwt.InvalidIssuerError,
+            jwt.MissingRequiredClaimError, jwt.ImmatureSignatureError):
+        raise AuthError({"code": "invalid_claims",
+                         "description":
+                             "incorrect claims,"
+                             "please check the audience and issuer"}, 401)
+    except Exception:
+        raise AuthError({"code": "invalid_header",
+                         "description":
+                             "Unable to parse authentication"
+                             " token."}, 401)
+
+    # reject tokens revoked before their expiry
+    jti = payload.get("jti")
+    if jti is not None and _is_revoked(jti):
+        raise AuthError({"code": "token_revoked",
+                         "description": "token has been revoked"}, 401)
+
+    # build the permission set once so check_permissions is a hash lookup
+    if 'permissions' in payload:
+        payload['_perms'] = frozenset(payload['permissions'])
+
+    return payload
 
 '''
 @DONE implement @requires_auth(permission) decorator method